@@ -2,24 +2,39 @@
 
 import discord
 from discord.ext import commands, tasks
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
 import asyncio
+import concurrent.futures
 import aiohttp
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+import soupsieve
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service as ChromeService
 from webdriver_manager.chrome import ChromeDriverManager
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException, SessionNotCreatedException
 from firebase_admin import credentials, firestore, initialize_app
+from google.api_core.exceptions import AlreadyExists, NotFound
+import atexit
 import os
-from datetime import datetime, date, timezone
+from datetime import datetime, date, timedelta, timezone
 import logging
 from typing import Optional, List, Dict, Any
+import hashlib
+import re
+import time
 import shutil
 import json
 import platform
+import random
 import sys
+from collections import defaultdict
+from functools import lru_cache
+from pathlib import PurePath
+from urllib.parse import urlparse
 from webdriver_manager.core.os_manager import OperationSystemManager, ChromeType
 from webdriver_manager.core.download_manager import DownloadManager
 from webdriver_manager.core.driver_cache import DriverCacheManager
@@ -49,27 +64,71 @@ except Exception as e:
     logging.error(f"Error initializing Firebase: {e}")
     exit()
 
-# Attempt to clear webdriver-manager cache once on startup
-logging.info("Attempting one-time webdriver-manager cache clear on startup...")
+# Prefer the locally cached chromedriver over webdriver-manager's online
+# version check, so driver resolution never blocks on the network when a
+# usable binary is already on disk.
+os.environ.setdefault('WDM_LOCAL', '1')
+os.environ.setdefault('WDM_LOG', '0')
+
+# Optionally clear the webdriver-manager cache on startup. This used to run
+# unconditionally, but wiping the cache forces a full chromedriver redownload on
+# the first JS fetch after every restart; webdriver-manager's own validity check
+# already reuses a good binary, so only wipe when explicitly requested.
+if os.environ.get('POKEALERT_FORCE_WDM_CLEAR'):
+    logging.info("POKEALERT_FORCE_WDM_CLEAR set, clearing webdriver-manager cache...")
+    try:
+        wdm_cache_root = os.path.expanduser("~/.wdm")
+        drivers_json_path = os.path.join(wdm_cache_root, "drivers.json")
+        drivers_dir_path = os.path.join(wdm_cache_root, "drivers")
+
+        if os.path.exists(drivers_json_path):
+            os.remove(drivers_json_path)
+            logging.info(f"Removed webdriver-manager cache file: {drivers_json_path}")
+
+        if os.path.exists(drivers_dir_path):
+            shutil.rmtree(drivers_dir_path)
+            logging.info(f"Removed webdriver-manager cache directory: {drivers_dir_path}")
+        logging.info("Finished webdriver-manager cache clear.")
+    except Exception as e:
+        logging.error(f"Error during webdriver-manager cache clear: {e}")
+
+# Load any existing webdriver-manager metadata once at startup so JS fetches can
+# reuse a cached chromedriver binary without re-contacting the release servers.
+_wdm_metadata: Dict[str, Any] = {}
 try:
-    wdm_cache_root = os.path.expanduser("~/.wdm")
-    drivers_json_path = os.path.join(wdm_cache_root, "drivers.json")
-    drivers_dir_path = os.path.join(wdm_cache_root, "drivers")
+    _drivers_json_path = os.path.join(os.path.expanduser("~/.wdm"), "drivers.json")
+    if os.path.exists(_drivers_json_path):
+        with open(_drivers_json_path) as f:
+            _wdm_metadata = json.load(f)
+        logging.info(f"Loaded webdriver-manager metadata for {len(_wdm_metadata)} cached driver(s).")
+except Exception as e:
+    logging.warning(f"Could not read webdriver-manager metadata: {e}")
+    _wdm_metadata = {}
 
-    if os.path.exists(drivers_json_path):
-        os.remove(drivers_json_path)
-        logging.info(f"Removed webdriver-manager cache file: {drivers_json_path}")
-    else:
-        logging.info(f"webdriver-manager cache file not found, no need to remove: {drivers_json_path}")
+def _cached_chromedriver_path() -> Optional[str]:
+    """Returns the path of a cached chromedriver binary if one is still on disk.
 
-    if os.path.exists(drivers_dir_path):
-        shutil.rmtree(drivers_dir_path)
-        logging.info(f"Removed webdriver-manager cache directory: {drivers_dir_path}")
-    else:
-        logging.info(f"webdriver-manager cache directory not found, no need to remove: {drivers_dir_path}")
-    logging.info("Finished one-time webdriver-manager cache clear attempt.")
-except Exception as e:
-    logging.error(f"Error during one-time webdriver-manager cache clear: {e}")
+    Avoids the LATEST_RELEASE HTTP round-trips that ChromeDriverManager().install()
+    performs even when the cached binary is perfectly valid.
+    """
+    try:
+        browser_version = OperationSystemManager().get_browser_version_from_os(ChromeType.GOOGLE)
+    except Exception as e:
+        logging.warning(f"Could not detect installed Chrome version: {e}")
+        browser_version = None
+    for key, entry in _wdm_metadata.items():
+        if '_chromedriver_' not in key:
+            continue
+        # Metadata keys end in "_for_{browser_version}"; only reuse a binary
+        # cached for the Chrome that is installed now, otherwise a driver left
+        # over from before a browser upgrade would be picked forever.
+        if browser_version and not key.endswith(f"_for_{browser_version}"):
+            continue
+        binary_path = entry.get('binary_path')
+        if binary_path and os.path.isfile(binary_path):
+            logging.info(f"Using cached chromedriver binary: {binary_path}")
+            return binary_path
+    return None
 
 # --- Custom WebDriver Manager components to fix binary identification ---
 class CustomDriverCacheManager(DriverCacheManager):
@@ -78,19 +137,24 @@ class CustomDriverCacheManager(DriverCacheManager):
         logging.debug(f"[CustomDriverCacheManager._find_correct_binary] Finding binary for '{driver_name}' in {files_in_archive}")
         
         normalized_driver_name = driver_name.lower()
-        expected_exe_filename = f"{normalized_driver_name}.exe"
-        expected_non_exe_filename = normalized_driver_name
+        is_windows = platform.system() == "Windows"
+        expected_filename = f"{normalized_driver_name}.exe" if is_windows else normalized_driver_name
 
+        # One pass over the archive listing, collecting the direct executable
+        # matches and the looser fallbacks at the same time.
         candidate_binaries = []
+        fallback_candidates = []
         for path_in_archive in files_in_archive:
-            filename_only = os.path.basename(path_in_archive).lower()
-            if platform.system() == "Windows":
-                if filename_only == expected_exe_filename:
-                    candidate_binaries.append(path_in_archive)
-            else: # Linux, macOS
-                if filename_only == expected_non_exe_filename and not path_in_archive.lower().endswith(".exe"):
-                    candidate_binaries.append(path_in_archive)
-        
+            filename_only = PurePath(path_in_archive).name.lower()
+            if filename_only == expected_filename and (is_windows or not filename_only.endswith(".exe")):
+                candidate_binaries.append(path_in_archive)
+                continue
+            name_lower = path_in_archive.lower()
+            if 'notice' in name_lower or 'license' in name_lower or name_lower.endswith(('.txt', '.xml', '.json', '.md', '.pdf', '.html')):
+                continue
+            if normalized_driver_name in os.path.splitext(filename_only)[0]:
+                fallback_candidates.append(path_in_archive)
+
         if candidate_binaries:
             if len(candidate_binaries) > 1:
                 # Prefer candidates in a subdirectory that often matches part of the driver/os name, e.g., "chromedriver-win64/chromedriver.exe"
@@ -105,14 +169,9 @@ class CustomDriverCacheManager(DriverCacheManager):
             return candidate_binaries[0]
 
         logging.warning(f"[CustomDriverCacheManager._find_correct_binary] No direct executable match for '{driver_name}'. Trying broader fallback.")
-        for path_in_archive in files_in_archive:
-            name_lower = path_in_archive.lower()
-            if 'notice' in name_lower or 'license' in name_lower or name_lower.endswith(('.txt', '.xml', '.json', '.md', '.pdf', '.html')):
-                continue
-            file_basename_no_ext = os.path.splitext(os.path.basename(name_lower))[0]
-            if normalized_driver_name in file_basename_no_ext:
-                logging.info(f"[CustomDriverCacheManager._find_correct_binary] Fallback found potential binary: '{path_in_archive}'")
-                return path_in_archive
+        if fallback_candidates:
+            logging.info(f"[CustomDriverCacheManager._find_correct_binary] Fallback found potential binary: '{fallback_candidates[0]}'")
+            return fallback_candidates[0]
 
         raise Exception(f"[CustomDriverCacheManager._find_correct_binary] Cannot find binary for '{driver_name}'. Files in archive: {files_in_archive}")
 
@@ -214,6 +273,108 @@ class CustomChromeDriverManager(ChromeDriverManager):
         # Ensures the os_type from our potentially customized os_system_manager is used.
         return self._os_system_manager.get_os_type()
 
+# --- Shared Selenium Driver ---
+# Launching headless Chrome (plus the chromedriver install check) costs seconds per
+# fetch, so a single driver instance is created lazily and reused across all
+# JavaScript fetches. Access is serialized through _driver_lock.
+_selenium_driver: Optional[webdriver.Chrome] = None
+_driver_lock = asyncio.Lock()
+# Headless Chrome leaks memory over long sessions; recycle the shared driver
+# after this many page fetches so the process footprint stays flat.
+_DRIVER_RECYCLE_AFTER_USES = 50
+_driver_uses = 0
+
+def _build_chrome_options() -> webdriver.ChromeOptions:
+    options = webdriver.ChromeOptions()
+    options.add_argument('--headless=new') # Use the new headless mode
+    options.add_argument('--disable-gpu')
+    options.add_argument('--no-sandbox')
+    options.add_argument('--start-maximized')
+    options.add_argument('--disable-dev-shm-usage')
+    options.add_argument('--log-level=3') # Suppress verbose ChromeDriver logs
+    options.add_argument("user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36")
+    return options
+
+# Built once at import; driver (re)creation only pays for the Chrome launch.
+_CHROME_OPTIONS = _build_chrome_options()
+
+# Resolved chromedriver binary path, memoized after the first lookup.
+_chromedriver_path: Optional[str] = None
+
+def _resolve_chromedriver_path() -> str:
+    """Resolves the chromedriver binary path once, preferring the disk cache."""
+    global _chromedriver_path
+    if _chromedriver_path is None or not os.path.isfile(_chromedriver_path):
+        _chromedriver_path = _cached_chromedriver_path()
+        if _chromedriver_path is None:
+            _chromedriver_path = CustomChromeDriverManager().install()
+    return _chromedriver_path
+
+# Selenium calls are synchronous and block for seconds; they run on this
+# dedicated executor so the event loop (heartbeats, commands, aiohttp fetches)
+# stays responsive during a JS fetch.
+_selenium_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=2, thread_name_prefix='selenium'
+)
+
+def _get_or_create_driver() -> webdriver.Chrome:
+    """Returns the shared headless Chrome driver, creating it on first use.
+
+    Recycles the instance every _DRIVER_RECYCLE_AFTER_USES fetches; a relaunch
+    costs a couple of seconds once in a while versus unbounded renderer growth.
+    """
+    global _selenium_driver, _driver_uses
+    if _selenium_driver is not None and _driver_uses >= _DRIVER_RECYCLE_AFTER_USES:
+        logging.info(f"Recycling shared Selenium driver after {_driver_uses} uses.")
+        _discard_driver()
+    if _selenium_driver is None:
+        service = ChromeService(_resolve_chromedriver_path())
+        _selenium_driver = webdriver.Chrome(service=service, options=_CHROME_OPTIONS)
+        _driver_uses = 0
+        logging.info("Shared Selenium driver initialized.")
+    _driver_uses += 1
+    return _selenium_driver
+
+def _discard_driver():
+    """Quits and forgets the shared driver so the next fetch recreates it."""
+    global _selenium_driver
+    if _selenium_driver is not None:
+        try:
+            _selenium_driver.quit()
+        except Exception as e:
+            logging.warning(f"Error quitting shared Selenium driver: {e}")
+        _selenium_driver = None
+
+def _selenium_fetch(url: str, wait_selector: Optional[str] = None) -> str:
+    """Synchronously fetches a JS-rendered page with the shared driver.
+
+    Runs on _selenium_executor; callers must hold _driver_lock so the shared
+    driver is never used from two threads at once. When wait_selector is
+    given, waits for the product's actual stock element to be mounted so the
+    sampled HTML is usable on the first fetch; otherwise waits for body.
+    """
+    driver = _get_or_create_driver()
+    driver.get(url)
+    try:
+        if wait_selector:
+            WebDriverWait(driver, 8).until(
+                EC.presence_of_element_located((By.CSS_SELECTOR, wait_selector))
+            )
+        else:
+            WebDriverWait(driver, 10).until(
+                EC.presence_of_element_located((By.TAG_NAME, "body"))
+            )
+    except TimeoutException:
+        # The element may legitimately be absent (e.g. out of stock); fall
+        # through and let the parser decide from whatever rendered.
+        logging.warning(f"Timed out waiting for '{wait_selector}' on {url}; using page as rendered.")
+    content = driver.page_source
+    # Reset state for the next fetch instead of quitting the driver
+    driver.delete_all_cookies()
+    return content
+
+atexit.register(_discard_driver)
+
 # --- Discord Bot Setup ---
 TOKEN = os.environ.get('DISCORD_BOT_TOKEN')  # Ensure you set your bot token as an environment variable
 if not TOKEN:
@@ -224,19 +385,379 @@ intents = discord.Intents.default()
 intents.message_content = True # Required for reading message content for commands
 intents.members = True # Required for checking member roles for admin commands
 
-bot = commands.Bot(command_prefix='/', intents=intents)
+class PokeAlertBot(commands.Bot):
+    """Bot subclass owning a shared aiohttp session for all scraping requests.
+
+    Opening a ClientSession per fetch pays a fresh TCP + TLS handshake every
+    time; a single pooled session keeps connections alive across checks.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.http_session: Optional[aiohttp.ClientSession] = None
+
+    async def setup_hook(self):
+        # limit_per_host matches the per-host fetch semaphore cap, so the
+        # connector never holds idle sockets the scraper can't actually use.
+        connector = aiohttp.TCPConnector(
+            limit=64,
+            limit_per_host=4,
+            ttl_dns_cache=300,
+            keepalive_timeout=60
+        )
+        self.http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=20),
+            headers={'User-Agent': 'Mozilla/5.0'}
+        )
+        logging.info("Shared aiohttp session initialized.")
+        self._notify_task = self.loop.create_task(_notification_worker())
+        logging.info("Notification worker started.")
+        start_products_listener()
+        start_subscriptions_listener()
+
+    async def close(self):
+        if self.http_session and not self.http_session.closed:
+            await self.http_session.close()
+            logging.info("Shared aiohttp session closed.")
+        await super().close()
+
+bot = PokeAlertBot(command_prefix='/', intents=intents)
 
 # --- Constants ---
 MONITORING_INTERVAL_SECONDS = 60  # 1 minute between checks (adjust as needed)
+IN_STOCK_CHECK_INTERVAL_SECONDS = 60    # re-check quickly while stock is available
+OUT_OF_STOCK_CHECK_INTERVAL_SECONDS = 300  # most checks find nothing; back off
 ADMIN_ROLE_NAME = os.environ.get('DISCORD_ADMIN_ROLE', "Bot Admin") # Configurable admin role name
 
+def _interval_for_status(status: str, consecutive_oos: int = 0) -> int:
+    """Seconds until a product with this stock status should be checked again.
+
+    In-stock products are re-checked quickly to catch the sell-out; products
+    that stay out of stock back off exponentially, capped at 8x the base, so
+    cold SKUs stop dominating the fetch budget.
+    """
+    if status == 'in_stock':
+        return IN_STOCK_CHECK_INTERVAL_SECONDS
+    return OUT_OF_STOCK_CHECK_INTERVAL_SECONDS * min(8, 2 ** max(0, consecutive_oos - 1))
+
+# Concurrency guards for site fetches: a global cap keeps the event loop from
+# being flooded when many products are checked at once, and a per-host cap keeps
+# any single store from seeing a burst of simultaneous requests (rate limits).
+_global_fetch_sem = asyncio.Semaphore(16)
+_host_semaphores: Dict[str, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(4))
+
+# Minimum spacing between requests to the same host. Unlike a fixed sleep
+# between products, hosts are throttled independently: bursts to distinct
+# stores proceed immediately and only same-host requests queue up.
+_HOST_MIN_GAP_SECONDS = 2.0
+_host_next: Dict[str, float] = defaultdict(float)
+
+# In-flight fetch coalescing: (url, requires_javascript) -> running Task.
+# Entries remove themselves on completion, so results are never reused across
+# bursts — only genuinely concurrent callers share a response.
+_inflight_fetches: Dict[tuple, asyncio.Task] = {}
+
+async def _throttle_host(host: str, gap: float = _HOST_MIN_GAP_SECONDS):
+    """Waits until this host's next request slot, then reserves the one after."""
+    now = asyncio.get_running_loop().time()
+    wait = max(0.0, _host_next[host] - now)
+    _host_next[host] = max(now, _host_next[host]) + gap
+    if wait:
+        await asyncio.sleep(wait)
+
+# Target stock indicators compiled into single automatons: one C-level regex
+# pass over the page replaces a separate O(n) substring scan per indicator.
+_TARGET_OOS_RE = re.compile(
+    r'sold out|out of stock|currently unavailable|temporarily out of stock|not available'
+)
+_TARGET_INSTOCK_RE = re.compile(r'add to cart')
+
+# Selector Selenium waits on for Target pages, where the per-product stock
+# selector isn't what the in-stock heuristics actually inspect.
+_TARGET_WAIT_SELECTOR = "[data-test='fulfillment-section'], [data-test='shipItButton']"
+
+# Target's hardcoded selectors compiled once; per-product parse state
+# (compiled selector, lowered expected text, strainer) is built lazily into
+# _parse_state so neither soupsieve's tokenizer nor the lowercasing reruns
+# on every check.
+_TARGET_CART_CSS = soupsieve.compile("button[data-test='shipItButton'], button.btn-primary")
+_TARGET_PRICE_CSS = soupsieve.compile("[data-test='product-price'], .styles__CurrentPriceContainer-sc-z5703i-0, .style__PriceFontSize-sc-__sc-13aaghm-0")
+_TARGET_FULFILL_CSS = soupsieve.compile("[data-test='fulfillment-section']")
+_parse_state: Dict[str, tuple] = {}
+
+def _parse_state_for(product: Dict[str, Any]) -> tuple:
+    """Returns (compiled_selector, expected_text_lower, strainer) for a
+    product, rebuilt only when its selector or expected text changes."""
+    selector = product['css_selector_for_stock']
+    expected = product.get('expected_in_stock_text', '')
+    state = _parse_state.get(product['id'])
+    if state is None or state[0] != selector or state[1] != expected:
+        state = (selector, expected, soupsieve.compile(selector),
+                 expected.lower(), _strainer_for_selector(selector))
+        _parse_state[product['id']] = state
+    return state[2], state[3], state[4]
+
+def invalidate_parse_state(product_id: str):
+    """Drops a product's cached parse state after admin edits or removal."""
+    _parse_state.pop(product_id, None)
+
+def _wait_selector_for(product: Dict[str, Any]) -> Optional[str]:
+    """Picks the CSS selector a JS fetch should wait on for this product."""
+    if product.get('store_name', '').lower() == 'target':
+        return _TARGET_WAIT_SELECTOR
+    return product.get('css_selector_for_stock')
+
+# Conditional-GET support: product pages are polled every cycle and most
+# responses are identical, so remember validators per URL and let the server
+# answer 304 with no body. UNCHANGED is the sentinel for that case.
+UNCHANGED = object()
+_etag_cache: Dict[str, tuple] = {}
+_last_status: Dict[str, str] = {}
+
+# Body-hash short-circuit, keyed by product id: (blake2b digest, status)
+_content_hash: Dict[str, tuple] = {}
+
 # --- Helper Functions ---
+# --- Firestore Async Helpers ---
+# The firebase_admin client is synchronous; these thin wrappers push its gRPC
+# round-trips onto worker threads so coroutines never block the event loop.
+async def fs_get(ref):
+    return await asyncio.to_thread(ref.get)
+
+async def fs_set(ref, data, merge=False):
+    await asyncio.to_thread(ref.set, data, merge=merge)
+
+async def fs_update(ref, data):
+    await asyncio.to_thread(ref.update, data)
+
+async def fs_delete(ref):
+    await asyncio.to_thread(ref.delete)
+
+async def fs_query(query):
+    return await asyncio.to_thread(lambda: list(query.stream()))
+
+# Firestore caps a WriteBatch at 500 operations; stay comfortably under it
+_FIRESTORE_BATCH_LIMIT = 400
+
+async def _commit_product_updates(updates: List[tuple]):
+    """Commits (product_id, update_data) pairs through a BulkWriter.
+
+    BulkWriter parallelizes and throttles its own RPCs with retries, so
+    arbitrarily large cycles need no manual 500-op chunking and aren't
+    serialized behind sequential batch commits.
+    """
+    if not updates:
+        return
+    def _commit():
+        writer = db.bulk_writer()
+        for product_id, update_data in updates:
+            writer.update(db.collection('monitored_products').document(product_id), update_data)
+        writer.close()
+    await asyncio.to_thread(_commit)
+
+# Short-lived in-process cache of the active monitored products, shared by the
+# command handlers so closely-spaced invocations don't each pay a Firestore
+# query round-trip.
+_PRODUCTS_CACHE_TTL_SECONDS = 30
+_products_cache: Dict[str, Any] = {'ts': 0.0, 'products': [], 'all_ts': 0.0, 'all': []}
+
+# Field projections for the fallback queries: everything the monitoring
+# pipeline (checks, notification embeds) or the listing command actually
+# reads, so unused payload never crosses the wire.
+_MONITOR_FIELDS = [
+    'name', 'store_name', 'url', 'checkout_url', 'css_selector_for_stock',
+    'expected_in_stock_text', 'requires_javascript', 'api_url',
+    'json_stock_path', 'is_active', 'last_stock_status',
+    'consecutive_out_of_stock_checks', 'next_check_at', 'etag',
+    'last_modified', 'last_restock_time'
+]
+_LISTING_FIELDS = [
+    'name', 'store_name', 'url', 'checkout_url', 'is_active',
+    'last_stock_status', 'last_checked'
+]
+
+# Push-updated mirror of monitored_products, kept fresh by a Firestore
+# on_snapshot listener so steady-state reads cost nothing. Until the first
+# snapshot arrives the TTL-cached query paths below serve as fallback.
+_products_by_id: Dict[str, Dict[str, Any]] = {}
+_products_listener_ready = False
+_products_watch = None
+
+def _on_products_snapshot(col_snapshot, changes, read_time):
+    """Applies monitored_products change deltas to the in-memory mirror.
+
+    Runs on the Firestore client's listener thread; plain dict assignment and
+    pop are atomic under the GIL, so readers on the event loop never see a
+    partially applied document.
+    """
+    global _products_listener_ready
+    for change in changes:
+        if change.type.name in ('ADDED', 'MODIFIED'):
+            product_data = change.document.to_dict()
+            product_data['id'] = change.document.id
+            _products_by_id[change.document.id] = product_data
+        elif change.type.name == 'REMOVED':
+            _products_by_id.pop(change.document.id, None)
+    _products_listener_ready = True
+
+def start_products_listener():
+    """Registers the monitored_products snapshot listener (idempotent)."""
+    global _products_watch
+    if _products_watch is None:
+        _products_watch = db.collection('monitored_products').on_snapshot(_on_products_snapshot)
+        logging.info("monitored_products snapshot listener registered.")
+
+# Companion mirror for subscriptions, maintained the same way, so restock
+# fan-out indexing never has to query the collection once the stream is live.
+_subs_by_doc: Dict[str, Dict[str, Any]] = {}
+_subs_listener_ready = False
+_subs_watch = None
+
+def _on_subscriptions_snapshot(col_snapshot, changes, read_time):
+    """Applies subscriptions change deltas to the in-memory mirror."""
+    global _subs_listener_ready
+    for change in changes:
+        if change.type.name in ('ADDED', 'MODIFIED'):
+            _subs_by_doc[change.document.id] = change.document.to_dict()
+        elif change.type.name == 'REMOVED':
+            _subs_by_doc.pop(change.document.id, None)
+    _subs_listener_ready = True
+
+def start_subscriptions_listener():
+    """Registers the subscriptions snapshot listener (idempotent)."""
+    global _subs_watch
+    if _subs_watch is None:
+        _subs_watch = db.collection('subscriptions').on_snapshot(_on_subscriptions_snapshot)
+        logging.info("subscriptions snapshot listener registered.")
+
+async def get_active_products() -> List[Dict[str, Any]]:
+    """Returns the active monitored products, cached for a short TTL."""
+    if _products_listener_ready:
+        return [p for p in list(_products_by_id.values()) if p.get('is_active', True)]
+
+    now = time.monotonic()
+    if _products_cache['products'] and now - _products_cache['ts'] < _PRODUCTS_CACHE_TTL_SECONDS:
+        return _products_cache['products']
+
+    docs = await fs_query(
+        db.collection('monitored_products').where('is_active', '==', True).select(_MONITOR_FIELDS)
+    )
+    products = []
+    for doc in docs:
+        product_data = doc.to_dict()
+        product_data['id'] = doc.id
+        products.append(product_data)
+    _products_cache['products'] = products
+    _products_cache['ts'] = now
+    return products
+
+async def get_all_products() -> List[Dict[str, Any]]:
+    """Returns every monitored product (active or not), ordered by name.
+
+    Backed by the same short TTL cache as get_active_products() so listing
+    commands issued in quick succession share one Firestore read.
+    """
+    if _products_listener_ready:
+        return sorted(list(_products_by_id.values()), key=lambda p: p.get('name', ''))
+
+    now = time.monotonic()
+    if _products_cache['all'] and now - _products_cache['all_ts'] < _PRODUCTS_CACHE_TTL_SECONDS:
+        return _products_cache['all']
+
+    docs = await fs_query(
+        db.collection('monitored_products').order_by('name').select(_LISTING_FIELDS)
+    )
+    products = []
+    for doc in docs:
+        product_data = doc.to_dict()
+        product_data['id'] = doc.id
+        products.append(product_data)
+    _products_cache['all'] = products
+    _products_cache['all_ts'] = now
+    return products
+
+def invalidate_products_cache():
+    """Forces the next cached product read to go back to Firestore."""
+    _products_cache['ts'] = 0.0
+    _products_cache['products'] = []
+    _products_cache['all_ts'] = 0.0
+    _products_cache['all'] = []
+
+async def resolve_product(keyword_or_id: str) -> Optional[Dict[str, Any]]:
+    """Resolves a product by exact ID or (case-insensitive) name.
+
+    Checks the in-process cache first, falling back to a direct Firestore
+    lookup so inactive products can still be targeted by ID.
+    """
+    products = await get_active_products()
+    for product in products:
+        if product['id'] == keyword_or_id:
+            return product
+    keyword_lower = keyword_or_id.lower()
+    for product in products:
+        if product.get('name', '').lower() == keyword_lower:
+            return product
+    # Unambiguous substring match, so users can say "151" for
+    # "Pokemon 151 Booster Bundle" without pasting the full name.
+    partial_matches = [p for p in products if keyword_lower in p.get('name', '').lower()]
+    if len(partial_matches) == 1:
+        return partial_matches[0]
+
+    # A warm mirror holds every product, inactive ones included, so a miss
+    # there is authoritative and no Firestore read is needed.
+    if _products_listener_ready:
+        return _products_by_id.get(keyword_or_id)
+
+    product_doc = await fs_get(db.collection('monitored_products').document(keyword_or_id))
+    if product_doc.exists:
+        product_data = product_doc.to_dict()
+        product_data['id'] = product_doc.id
+        return product_data
+
+    # Cold-start name lookup: one indexed equality query on the normalized
+    # name instead of scanning the collection client-side.
+    docs = await fs_query(
+        db.collection('monitored_products').where('name_lower', '==', keyword_lower).limit(1)
+    )
+    if docs:
+        product_data = docs[0].to_dict()
+        product_data['id'] = docs[0].id
+        return product_data
+    return None
+
+def _subscribed_ids(sub_data: Dict[str, Any]) -> List[str]:
+    """Returns the subscribed product ids from a subscription document.
+
+    Subscriptions store subscribed_product_ids as a map of product_id -> True
+    so membership changes are O(1) dotted-path updates; older documents that
+    still hold a list are read transparently.
+    """
+    raw = sub_data.get('subscribed_product_ids') or {}
+    if isinstance(raw, dict):
+        return [pid for pid, enabled in raw.items() if enabled]
+    return list(raw)
+
+def _subscription_queries_for_product(product_id: str):
+    """Queries matching subscriptions to a product under both schema layouts."""
+    return (
+        db.collection('subscriptions').where(f'subscribed_product_ids.{product_id}', '==', True),
+        db.collection('subscriptions').where('subscribed_product_ids', 'array_contains', product_id),
+    )
+
+# Admin role id per guild, resolved once by name and then compared by id so
+# the per-command check is a membership test instead of a role-name scan.
+_admin_role_cache: Dict[int, Optional[int]] = {}
+
 def is_admin():
     """Custom check to see if the command invoker has the admin role or is the guild owner."""
     async def predicate(ctx):
         if ctx.guild: # Command invoked in a guild
-            admin_role = discord.utils.get(ctx.guild.roles, name=ADMIN_ROLE_NAME)
-            if admin_role and admin_role in ctx.author.roles:
+            if ctx.guild.id not in _admin_role_cache:
+                admin_role = discord.utils.get(ctx.guild.roles, name=ADMIN_ROLE_NAME)
+                _admin_role_cache[ctx.guild.id] = admin_role.id if admin_role else None
+            admin_role_id = _admin_role_cache[ctx.guild.id]
+            if admin_role_id is not None and any(role.id == admin_role_id for role in ctx.author.roles):
                 return True
             if ctx.author == ctx.guild.owner:
                 return True
@@ -244,67 +765,117 @@ def is_admin():
         return False
     return commands.check(predicate)
 
+@bot.event
+async def on_guild_role_update(before, after):
+    """Drops the cached admin role id when a role is renamed to/from it."""
+    if ADMIN_ROLE_NAME in (before.name, after.name):
+        _admin_role_cache.pop(after.guild.id, None)
+
+@bot.event
+async def on_guild_role_create(role):
+    """Drops a cached miss when a role with the admin name is created."""
+    if role.name == ADMIN_ROLE_NAME:
+        _admin_role_cache.pop(role.guild.id, None)
+
+@bot.event
+async def on_guild_role_delete(role):
+    """Drops the cached admin role id if the admin role itself is deleted."""
+    if role.name == ADMIN_ROLE_NAME:
+        _admin_role_cache.pop(role.guild.id, None)
+
+@lru_cache(maxsize=512)
+def _format_timestamp_seconds(ts_seconds: int) -> str:
+    """Formats whole-second epoch timestamps; cached since Firestore
+    timestamps repeat across listings and embeds within a cycle."""
+    return datetime.fromtimestamp(ts_seconds, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+
 def format_timestamp(dt: datetime) -> str:
     """Formats a datetime object into a readable UTC string."""
-    return dt.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+    return _format_timestamp_seconds(int(dt.timestamp()))
 
-async def fetch_website_content(url: str, requires_javascript: bool = False) -> Optional[str]:
+async def fetch_website_content(url: str, requires_javascript: bool = False,
+                                wait_selector: Optional[str] = None) -> Optional[Any]:
     """
     Fetches the content of a website. Uses Selenium for JavaScript-rendered pages,
-    otherwise uses aiohttp for static content.
+    otherwise uses aiohttp for static content. Concurrency is bounded globally
+    and per host so parallel checks can't overwhelm a single store.
     """
+    # Coalesce concurrent fetches of the same page (products sharing a
+    # listing URL check it once per burst instead of once per product).
+    key = (url, requires_javascript)
+    task = _inflight_fetches.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_with_limits(url, requires_javascript, wait_selector))
+        _inflight_fetches[key] = task
+        task.add_done_callback(lambda _t: _inflight_fetches.pop(key, None))
+    return await task
+
+async def _fetch_with_limits(url: str, requires_javascript: bool,
+                             wait_selector: Optional[str]) -> Optional[Any]:
+    host = urlparse(url).netloc
+    await _throttle_host(host)
+    async with _global_fetch_sem, _host_semaphores[host]:
+        return await _fetch_website_content_inner(url, requires_javascript, wait_selector)
+
+async def _fetch_website_content_inner(url: str, requires_javascript: bool = False,
+                                       wait_selector: Optional[str] = None) -> Optional[Any]:
     try:
         if requires_javascript:
             logging.info(f"Fetching {url} using Selenium (requires_javascript=True).")
-            try:
-                # --- Start of Selenium setup ---
-                # Use CustomChromeDriverManager with CustomDriverCacheManager
-                custom_cache_manager = CustomDriverCacheManager()
-                webdriver_path = CustomChromeDriverManager(
-                    cache_manager=custom_cache_manager
-                ).install()
-                service = ChromeService(webdriver_path)
-
-                options = webdriver.ChromeOptions()
-                options.add_argument('--headless=new') # Use the new headless mode
-                options.add_argument('--disable-gpu')
-                options.add_argument('--no-sandbox')
-                options.add_argument('--start-maximized')
-                options.add_argument('--disable-dev-shm-usage')
-                options.add_argument('--log-level=3') # Suppress verbose ChromeDriver logs
-                # Keep the existing user-agent
-                options.add_argument("user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36")
-
-                driver = webdriver.Chrome(service=service, options=options)
-                logging.info(f"Selenium driver initialized for {url}.")
-                # --- End of Selenium setup ---
-                
-                driver.get(url)
-                # Wait for page to load, or for a specific element to be present
-                WebDriverWait(driver, 10).until(
-                    EC.presence_of_element_located((By.TAG_NAME, "body"))
-                )
-                content = driver.page_source
-                driver.quit()
-                return content
-            except Exception as e: # This 'e' is the broader Selenium setup/initialization error
-                logging.error(f"Error setting up or running Selenium for {url}: {e}")
-                # Fall back to aiohttp
-                return await fetch_with_aiohttp(url)
+            async with _driver_lock:
+                try:
+                    return await asyncio.get_running_loop().run_in_executor(
+                        _selenium_executor, _selenium_fetch, url, wait_selector
+                    )
+                except Exception as e: # This 'e' is the broader Selenium setup/initialization error
+                    logging.error(f"Error setting up or running Selenium for {url}: {e}")
+                    # Discard the driver so a fresh one is created on the next
+                    # attempt; done while still holding _driver_lock so the
+                    # shared driver is never quit under a queued fetch.
+                    _discard_driver()
+                    if isinstance(e, SessionNotCreatedException):
+                        # The memoized chromedriver no longer matches the installed
+                        # Chrome (typically after a browser upgrade); forget it so
+                        # the next attempt re-resolves instead of failing forever.
+                        global _chromedriver_path
+                        _chromedriver_path = None
+            # Fall back to aiohttp (outside the lock; queued Selenium fetches
+            # shouldn't wait on an HTTP round-trip).
+            return await fetch_with_aiohttp(url)
         else:
             return await fetch_with_aiohttp(url)
     except Exception as e:
         logging.error(f"Error fetching {url}: {e}")
         return None
 
-async def fetch_with_aiohttp(url: str) -> Optional[str]:
-    """Helper function to fetch content using aiohttp."""
+async def fetch_with_aiohttp(url: str) -> Optional[Any]:
+    """Helper function to fetch content using aiohttp.
+
+    Sends If-None-Match/If-Modified-Since when validators are known for the
+    URL and returns the UNCHANGED sentinel on a 304 response.
+    """
     try:
         logging.info(f"Fetching {url} using aiohttp.")
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers={'User-Agent': 'Mozilla/5.0'}) as response:
-                response.raise_for_status() # Raise an exception for HTTP errors
-                return await response.text()
+        # User-Agent comes from the shared session's default headers; only
+        # the per-URL conditional validators are added here.
+        headers = {}
+        cached_validators = _etag_cache.get(url)
+        if cached_validators:
+            etag, last_modified = cached_validators
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        async with bot.http_session.get(url, headers=headers) as response:
+            if response.status == 304:
+                logging.info(f"{url} not modified since last check (HTTP 304).")
+                return UNCHANGED
+            response.raise_for_status() # Raise an exception for HTTP errors
+            etag = response.headers.get('ETag', '')
+            last_modified = response.headers.get('Last-Modified', '')
+            if etag or last_modified:
+                _etag_cache[url] = (etag, last_modified)
+            return await response.text()
     except aiohttp.ClientError as e:
         logging.error(f"HTTP error fetching {url} with aiohttp: {e}")
         return None
@@ -312,96 +883,257 @@ async def fetch_with_aiohttp(url: str) -> Optional[str]:
         logging.error(f"Error fetching {url} with aiohttp: {e}")
         return None
 
+def _strainer_for_selector(css_selector: str) -> Optional[SoupStrainer]:
+    """Builds a SoupStrainer scoped to the selector's leading tag name, if any.
+
+    Parsing only the relevant subtree avoids building a full document tree just
+    to evaluate a single selector. Returns None for selectors that don't start
+    with a plain tag name (e.g. '.class' or '#id').
+    """
+    match = re.match(r'\s*([a-zA-Z][a-zA-Z0-9-]*)', css_selector)
+    if match:
+        return SoupStrainer(match.group(1).lower())
+    return None
+
 async def check_stock_status(product: Dict[str, Any]) -> str:
     """
     Checks the stock status of a product by parsing the fetched HTML content.
     Returns "in_stock", "out_of_stock", or "unknown".
     """
-    content = await fetch_website_content(product['url'], product.get('requires_javascript', False))
+    status = await _check_stock_status_inner(product)
+    _last_status[product['id']] = status
+    return status
+
+# Products whose JS-flagged pages turned out not to expose stock state in
+# static HTML; they go straight to Selenium on subsequent checks.
+_needs_selenium: set = set()
+
+async def _check_stock_status_inner(product: Dict[str, Any]) -> str:
+    # Cheapest path first: a JSON endpoint, when the product defines one,
+    # answers in one small request with no HTML parsing at all.
+    if product.get('api_url'):
+        status = await _check_stock_via_api(product)
+        if status != "unknown":
+            return status
+
+    requires_js = product.get('requires_javascript', False)
+    # HTTP-first heuristic: many JS-flagged pages still ship the stock datum
+    # in the static HTML (inline state blobs, SSR markup). Try the cheap
+    # fetch; only escalate to Selenium when the parse comes back empty, and
+    # remember the escalation so the double fetch is paid at most once.
+    # Target is excluded: its parser infers out-of-stock from missing app
+    # markup, which a static fetch can't distinguish from an unrendered page.
+    if (requires_js and product['store_name'].lower() != 'target'
+            and product['id'] not in _needs_selenium):
+        status = await _fetch_and_parse(product, use_javascript=False)
+        if status is not None and status != "unknown":
+            return status
+        _needs_selenium.add(product['id'])
+        logging.info(
+            f"Static HTML insufficient for {product['name']}; escalating to Selenium "
+            f"({len(_needs_selenium)} products escalated so far)."
+        )
+
+    status = await _fetch_and_parse(product, use_javascript=requires_js)
+    return status if status is not None else "unknown" # Content could not be fetched
+
+async def _fetch_and_parse(product: Dict[str, Any], use_javascript: bool) -> Optional[str]:
+    """Fetches the product page and parses a status; None when the fetch fails."""
+    # Seed the validator cache from the product document so conditional GETs
+    # work from the first post-restart check, not just the second.
+    if product['url'] not in _etag_cache and (product.get('etag') or product.get('last_modified')):
+        _etag_cache[product['url']] = (product.get('etag', ''), product.get('last_modified', ''))
+    content = await fetch_website_content(
+        product['url'],
+        use_javascript,
+        wait_selector=_wait_selector_for(product)
+    )
+    if content is UNCHANGED:
+        # Page bytes haven't changed since the last check; reuse that result
+        logging.info(f"Content unchanged for {product['name']}, reusing last status.")
+        return _last_status.get(product['id'], product.get('last_stock_status', 'unknown'))
     if content:
-        soup = BeautifulSoup(content, 'html.parser')
-        try:
-            # Special handling for Target
-            if product['store_name'].lower() == 'target':
-                page_text = soup.get_text().lower()
-                
-                # Check for definitive out-of-stock indicators first (higher priority)
-                out_of_stock_indicators = [
-                    "sold out",
-                    "out of stock", 
-                    "currently unavailable",
-                    "temporarily out of stock", 
-                    "not available"
-                ]
-                if any(indicator in page_text for indicator in out_of_stock_indicators):
-                    logging.info(f"Found out-of-stock indicator for {product['name']}")
-                    return "out_of_stock"
-                
-                # Count in-stock indicators
-                in_stock_indicators = 0
-                
-                # Check 1: "add to cart" text in page
-                if "add to cart" in page_text:
-                    logging.info(f"Found 'add to cart' text for {product['name']}")
-                    in_stock_indicators += 1
-                
-                # Check 2: Add to cart button exists
-                add_to_cart_buttons = soup.select("button[data-test='shipItButton'], button.btn-primary")
-                if add_to_cart_buttons:
-                    for button in add_to_cart_buttons:
-                        button_text = button.get_text().strip().lower()
-                        if "add" in button_text and "cart" in button_text:
-                            logging.info(f"Found add to cart button element for {product['name']}")
-                            in_stock_indicators += 1
-                            break
-                
-                # Check 3: Price is displayed (usually indicates in stock)
-                price_elements = soup.select("[data-test='product-price'], .styles__CurrentPriceContainer-sc-z5703i-0, .style__PriceFontSize-sc-__sc-13aaghm-0")
+        # Even without server validators most pages are byte-identical between
+        # runs; hash the body and skip all parsing when nothing changed. Keyed
+        # per fetch mode: static and rendered HTML of one page differ.
+        content_hash = hashlib.blake2b(content.encode('utf-8', 'ignore'), digest_size=16).digest()
+        cache_key = (product['id'], use_javascript)
+        cached = _content_hash.get(cache_key)
+        if cached and cached[0] == content_hash:
+            logging.info(f"Content hash unchanged for {product['name']}, skipping parse.")
+            return cached[1]
+        # Parsing is pure CPU (lxml releases the GIL); run it on a worker
+        # thread so concurrent checks keep the event loop free for Discord
+        # heartbeats and other fetches.
+        status = await asyncio.to_thread(_parse_stock_status, content, product, use_javascript)
+        _content_hash[cache_key] = (content_hash, status)
+        return status
+    return None
+
+async def _check_stock_via_api(product: Dict[str, Any]) -> str:
+    """Evaluates the product's JSON stock endpoint, if configured.
+
+    Walks json_stock_path (dotted keys) into the response and maps the value
+    to a status; any miss or error returns "unknown" so callers fall back to
+    the HTML paths.
+    """
+    path = product.get('json_stock_path', '')
+    if not path:
+        return "unknown"
+    try:
+        async with bot.http_session.get(product['api_url']) as response:
+            response.raise_for_status()
+            data = await response.json(content_type=None)
+        value = data
+        for part in path.split('.'):
+            if not isinstance(value, dict) or part not in value:
+                return "unknown"
+            value = value[part]
+        if isinstance(value, bool):
+            return "in_stock" if value else "out_of_stock"
+        if isinstance(value, (int, float)):
+            return "in_stock" if value > 0 else "out_of_stock"
+        if isinstance(value, str):
+            lowered = value.lower()
+            expected = product.get('expected_in_stock_text', '').lower()
+            if expected and expected in lowered:
+                return "in_stock"
+            if lowered in ('in_stock', 'instock', 'in stock', 'available'):
+                return "in_stock"
+            if lowered in ('out_of_stock', 'oos', 'sold out', 'unavailable'):
+                return "out_of_stock"
+    except Exception as e:
+        logging.warning(f"API stock check failed for {product['name']} at {product['api_url']}: {e}")
+    return "unknown"
+
+def _parse_stock_status(content: str, product: Dict[str, Any], used_javascript: bool = False) -> str:
+    """Derives a stock status from fetched HTML. Pure CPU, no I/O.
+
+    used_javascript records how the content was fetched, so fast-path
+    verdicts aren't trusted on the unrendered HTML of a JS-flagged page.
+    """
+    try:
+        # Special handling for Target
+        if product['store_name'].lower() == 'target':
+            # Scan the raw HTML first: most out-of-stock pages short-circuit
+            # here without ever building a parse tree.
+            lowered = content.lower()
+
+            # Check for definitive out-of-stock indicators first (higher priority)
+            if _TARGET_OOS_RE.search(lowered):
+                logging.info(f"Found out-of-stock indicator for {product['name']}")
+                return "out_of_stock"
+
+            # Count in-stock indicators
+            in_stock_indicators = 0
+
+            # Check 1: "add to cart" text in page
+            has_cart_text = bool(_TARGET_INSTOCK_RE.search(lowered))
+            if has_cart_text:
+                logging.info(f"Found 'add to cart' text for {product['name']}")
+                in_stock_indicators += 1
+
+            # Each element check below leaves a tell-tale marker in the raw
+            # markup; if none of them appear anywhere, no selector can match
+            # and the page is out of stock without ever building a parse tree.
+            if not (has_cart_text
+                    or 'product-price' in lowered
+                    or 'shipitbutton' in lowered
+                    or 'fulfillment-section' in lowered
+                    or 'currentpricecontainer' in lowered):
+                return "out_of_stock"  # No indicators at all
+
+            soup = BeautifulSoup(content, 'lxml')
+            
+            # Check 2: Add to cart button exists
+            add_to_cart_buttons = _TARGET_CART_CSS.select(soup)
+            if add_to_cart_buttons:
+                for button in add_to_cart_buttons:
+                    button_text = button.get_text().strip().lower()
+                    if "add" in button_text and "cart" in button_text:
+                        logging.info(f"Found add to cart button element for {product['name']}")
+                        in_stock_indicators += 1
+                        break
+            
+            # Check 3: Price is displayed (usually indicates in stock). Two
+            # indicators already decide the outcome, so later selector scans
+            # only run while the verdict is still open.
+            if in_stock_indicators < 2:
+                price_elements = _TARGET_PRICE_CSS.select(soup)
                 if price_elements:
                     logging.info(f"Found price element for {product['name']}")
                     in_stock_indicators += 1
-                
-                # Check 4: Ship it or pickup buttons (strong indicator of in-stock)
-                shipping_elements = soup.select("[data-test='fulfillment-section']")
+
+            # Check 4: Ship it or pickup buttons (strong indicator of in-stock)
+            if in_stock_indicators < 2:
+                shipping_elements = _TARGET_FULFILL_CSS.select(soup)
                 if shipping_elements:
                     logging.info(f"Found shipping/pickup options for {product['name']}")
                     in_stock_indicators += 1
-                
-                # Decision logic - require at least two indicators for confidence
-                if in_stock_indicators >= 2:
-                    return "in_stock"
-                elif in_stock_indicators == 0:
-                    return "out_of_stock"  # No indicators at all
-                else:
-                    # Just one indicator - not enough confidence
-                    logging.warning(f"Ambiguous stock status for {product['name']} - treating as out_of_stock until confirmed")
-                    return "out_of_stock"
-                
+
+
+            # Decision logic - require at least two indicators for confidence
+            if in_stock_indicators >= 2:
+                return "in_stock"
+            elif in_stock_indicators == 0:
+                return "out_of_stock"  # No indicators at all
             else:
-                # Non-Target stores use the standard checking method
-                element = soup.select_one(product['css_selector_for_stock'])
-                
-                if element:
-                    # Check text content
-                    if product['expected_in_stock_text'].lower() in element.get_text(strip=True).lower():
+                # Just one indicator - not enough confidence
+                logging.warning(f"Ambiguous stock status for {product['name']} - treating as out_of_stock until confirmed")
+                return "out_of_stock"
+            
+        else:
+            # Non-Target stores use the standard checking method; scope the
+            # parse to the selector's root tag where possible
+            css, expected_lower, strainer = _parse_state_for(product)
+            # Cheap raw scan first: if the expected text appears nowhere in
+            # the page, no element can carry it, so skip building a parse
+            # tree. Only trusted when the selector has matched before — on an
+            # 'unknown' streak we parse anyway so breakage still gets logged —
+            # and when the content was fetched the way the product requires:
+            # the static probe of a JS-flagged page legitimately lacks the
+            # phrase, and a definitive verdict there would block escalation.
+            if (expected_lower and expected_lower not in content.lower()
+                    and used_javascript == product.get('requires_javascript', False)
+                    and product.get('last_stock_status') in ('in_stock', 'out_of_stock')):
+                return "out_of_stock"
+            soup = BeautifulSoup(content, 'lxml', parse_only=strainer)
+            element = css.select_one(soup)
+
+            if element:
+                # Check text content
+                if expected_lower in element.get_text(strip=True).lower():
+                    return "in_stock"
+                # Check common attributes like 'class' or 'data-stock'
+                for attr in ['class', 'data-stock', 'data-status']:
+                    if attr in element.attrs and expected_lower in ' '.join(element.attrs[attr]).lower():
                         return "in_stock"
-                    # Check common attributes like 'class' or 'data-stock'
-                    for attr in ['class', 'data-stock', 'data-status']:
-                        if attr in element.attrs and product['expected_in_stock_text'].lower() in ' '.join(element.attrs[attr]).lower():
-                            return "in_stock"
-                    # If element found but expected text/attribute not present, assume out of stock
-                    return "out_of_stock"
-                else:
-                    logging.warning(f"Could not find stock status element for {product['name']} (ID: {product['id']}) at {product['url']} using selector '{product['css_selector_for_stock']}'.")
-                    return "unknown" # Element not found, status is unknown
-        except Exception as e:
-            logging.error(f"Error parsing stock status for {product['name']} (ID: {product['id']}) at {product['url']}: {e}")
-            return "unknown"
-    return "unknown" # Content could not be fetched
+                # If element found but expected text/attribute not present, assume out of stock
+                return "out_of_stock"
+            else:
+                logging.warning(f"Could not find stock status element for {product['name']} (ID: {product['id']}) at {product['url']} using selector '{product['css_selector_for_stock']}'.")
+                return "unknown" # Element not found, status is unknown
+    except Exception as e:
+        logging.error(f"Error parsing stock status for {product['name']} (ID: {product['id']}) at {product['url']}: {e}")
+        return "unknown"
+
+# --- Notification Queue ---
+# A real restock fires every subscriber of a product at once. Sends are pushed
+# through a queue drained by a single worker behind a global token bucket
+# (just under Discord's 50/s cap) and a small per-target bucket, and the
+# Firestore "last notified" bookkeeping is committed in batches instead of one
+# update per send.
+_notify_queue: asyncio.Queue = asyncio.Queue()
+_global_send_limiter = AsyncLimiter(45, 1)
+_target_send_limiters: Dict[str, AsyncLimiter] = {}
+
+# Resolved notification targets, cached briefly: bot.fetch_user is a Discord
+# API call, and repeated alerts to the same DM user shouldn't pay it each time.
+_target_cache: TTLCache = TTLCache(maxsize=4096, ttl=600)
 
 async def send_restock_notification(product: Dict[str, Any], subscriber_id: str):
     """
-    Sends a restock notification to a specific subscribed channel/user.
+    Queues a restock notification for a specific subscribed channel/user.
     """
     embed = discord.Embed(
         title=f"🚨 RESTOCK ALERT! 🚨",
@@ -414,27 +1146,87 @@ async def send_restock_notification(product: Dict[str, Any], subscriber_id: str)
     embed.set_thumbnail(url="https://placehold.co/100x100/00FF00/FFFFFF?text=POKEMON") # Placeholder image
     embed.set_footer(text="Powered by Pokémon Restock Bot | Happy Hunting!")
 
+    await _notify_queue.put((subscriber_id, product, embed))
+
+async def _deliver_notification(subscriber_id: str, product: Dict[str, Any], embed: discord.Embed) -> bool:
+    """Actually sends one queued notification. Returns True on success.
+
+    429 responses are retried with exponential backoff plus jitter, honouring
+    the Retry-After header when Discord provides one, so a burst of restock
+    notifications doesn't silently drop messages.
+    """
     try:
-        # Try to get channel first, then user if it's a DM
-        target_entity = bot.get_channel(int(subscriber_id))
+        # Try the cache, then channel lookup, then user fetch if it's a DM
+        target_entity = _target_cache.get(subscriber_id)
+        if not target_entity:
+            target_entity = bot.get_channel(int(subscriber_id))
         if not target_entity:
             target_entity = await bot.fetch_user(int(subscriber_id))
-
         if target_entity:
-            await target_entity.send(embed=embed)
-            logging.info(f"Restock notification sent to {target_entity.name} (ID: {subscriber_id}) for {product['name']}.")
+            _target_cache[subscriber_id] = target_entity
 
-            # Update last notified timestamp in Firestore
-            sub_ref = db.collection('subscriptions').document(subscriber_id)
-            sub_ref.update({f'last_notified_timestamps.{product["id"]}': firestore.SERVER_TIMESTAMP})
-        else:
+        if not target_entity:
             logging.warning(f"Could not find Discord channel or user with ID {subscriber_id} to send notification.")
+            return False
+
+        for attempt in range(5):
+            try:
+                await target_entity.send(embed=embed)
+                logging.info(f"Restock notification sent to {target_entity.name} (ID: {subscriber_id}) for {product['name']}.")
+                return True
+            except discord.HTTPException as e:
+                if e.status == 429 and attempt < 4:
+                    try:
+                        retry_after = float(e.response.headers.get('Retry-After', 2 ** attempt))
+                    except (AttributeError, TypeError, ValueError):
+                        retry_after = float(2 ** attempt)
+                    delay = retry_after + random.uniform(0, 0.5)
+                    logging.warning(f"Rate limited sending to {subscriber_id}; retrying in {delay:.1f}s (attempt {attempt + 1}).")
+                    await asyncio.sleep(delay)
+                    continue
+                logging.error(f"Discord API error sending notification to {subscriber_id}: {e}")
+                return False
     except discord.Forbidden:
         logging.warning(f"Bot lacks permissions to send messages to {subscriber_id}.")
-    except discord.HTTPException as e:
-        logging.error(f"Discord API error sending notification to {subscriber_id}: {e}")
     except Exception as e:
         logging.error(f"Unexpected error sending notification to {subscriber_id}: {e}")
+    return False
+
+async def _flush_notified_timestamps(pending: List[tuple]):
+    """Commits queued last_notified_timestamps updates in one WriteBatch."""
+    if not pending:
+        return
+    def _commit():
+        batch = db.batch()
+        for subscriber_id, product_id in pending:
+            batch.update(
+                db.collection('subscriptions').document(subscriber_id),
+                {f'last_notified_timestamps.{product_id}': firestore.SERVER_TIMESTAMP}
+            )
+        batch.commit()
+    try:
+        await asyncio.to_thread(_commit)
+    except Exception as e:
+        logging.error(f"Error flushing notification timestamps to Firestore: {e}")
+
+async def _notification_worker():
+    """Background consumer draining the notification queue, rate-limited."""
+    pending_updates: List[tuple] = []
+    while True:
+        subscriber_id, product, embed = await _notify_queue.get()
+        try:
+            per_target = _target_send_limiters.setdefault(subscriber_id, AsyncLimiter(5, 5))
+            async with _global_send_limiter, per_target:
+                if await _deliver_notification(subscriber_id, product, embed):
+                    pending_updates.append((subscriber_id, product['id']))
+            # Flush bookkeeping when the queue drains or the batch limit nears
+            if _notify_queue.empty() or len(pending_updates) >= _FIRESTORE_BATCH_LIMIT:
+                await _flush_notified_timestamps(pending_updates)
+                pending_updates = []
+        except Exception as e:
+            logging.error(f"Notification worker error for {subscriber_id}: {e}")
+        finally:
+            _notify_queue.task_done()
 
 # --- Bot Commands ---
 @bot.command(name='subscribe', help='Subscribe to restock alerts. Usage: /subscribe [product_keyword_or_id]')
@@ -445,58 +1237,54 @@ async def subscribe(ctx, product_keyword_or_id: Optional[str] = None):
     guild_id = str(ctx.guild.id) if ctx.guild else None # Guild ID is null for DMs
 
     sub_ref = db.collection('subscriptions').document(entity_id)
-    sub_doc = sub_ref.get()
 
-    if not sub_doc.exists:
-        sub_ref.set({
-            'discord_guild_id': guild_id,
-            'subscribed_product_ids': [], # Initialize as empty list
-            'notification_preference': 'specific_products', # Default to specific if no keyword, will be updated
-            'last_notified_timestamps': {}
-        })
-        # Re-fetch the document after creation
-        sub_doc = sub_ref.get()
-
-    current_subscriptions = sub_doc.to_dict().get('subscribed_product_ids', [])
-    
+    # Membership comes from the subscriptions mirror when its stream is live;
+    # the read below only happens on cold start.
+    if _subs_listener_ready:
+        sub_data = _subs_by_doc.get(entity_id, {})
+    else:
+        sub_doc = await fs_get(sub_ref)
+        sub_data = sub_doc.to_dict() if sub_doc.exists else {}
+    current_subscriptions = _subscribed_ids(sub_data)
+    has_legacy_list = isinstance(sub_data.get('subscribed_product_ids'), list)
+
     if product_keyword_or_id is None:
-        # Subscribe to all products
-        all_products_docs = db.collection('monitored_products').where('is_active', '==', True).get()
-        all_active_product_ids = [doc.id for doc in all_products_docs]
-        
-        sub_ref.update({
-            'subscribed_product_ids': all_active_product_ids,
+        # Subscribe to all products; a merge set creates the document if
+        # needed and replaces the subscription map in one write.
+        all_active_product_ids = [p['id'] for p in await get_active_products()]
+
+        await fs_set(sub_ref, {
+            'discord_guild_id': guild_id,
+            'subscribed_product_ids': {pid: True for pid in all_active_product_ids},
             'notification_preference': 'all_products'
-        })
+        }, merge=True)
         await ctx.send(f"✅ This {'channel' if ctx.guild else 'user'} has subscribed to **all** currently monitored Pokémon card products.")
         logging.info(f"User/Channel {entity_id} subscribed to all products.")
     else:
-        # Subscribe to a specific product
-        product_to_subscribe_id = None
-        
-        # Try by exact ID first
-        product_doc = db.collection('monitored_products').document(product_keyword_or_id).get()
-        if product_doc.exists:
-            product_to_subscribe_id = product_doc.id
-        else:
-            # Try by name (case-insensitive search)
-            products_by_name = db.collection('monitored_products').where('name', '==', product_keyword_or_id).get()
-            if products_by_name:
-                product_to_subscribe_id = products_by_name[0].id # Take the first match
-                product_doc = products_by_name[0] # Update product_doc for confirmation message
+        # Subscribe to a specific product (resolved by ID or name from the cache)
+        product = await resolve_product(product_keyword_or_id)
 
-        if product_to_subscribe_id:
+        if product:
+            product_to_subscribe_id = product['id']
+            product_name = product['name']
             if product_to_subscribe_id not in current_subscriptions:
-                current_subscriptions.append(product_to_subscribe_id)
-                sub_ref.update({
-                    'subscribed_product_ids': list(set(current_subscriptions)), # Ensure unique
+                # Server-side map merge: atomic, race-free, and no
+                # create-then-update dance for first-time subscribers. A merge
+                # onto a legacy array field would replace the whole array with
+                # a one-key map, so legacy docs get the full converted map.
+                if has_legacy_list:
+                    new_subscriptions = {pid: True for pid in current_subscriptions}
+                    new_subscriptions[product_to_subscribe_id] = True
+                else:
+                    new_subscriptions = {product_to_subscribe_id: True}
+                await fs_set(sub_ref, {
+                    'discord_guild_id': guild_id,
+                    'subscribed_product_ids': new_subscriptions,
                     'notification_preference': 'specific_products'
-                })
-                product_name = product_doc.to_dict()['name']
+                }, merge=True)
                 await ctx.send(f"✅ This {'channel' if ctx.guild else 'user'} has subscribed to restock alerts for '{product_name}'.")
                 logging.info(f"User/Channel {entity_id} subscribed to product: {product_name} (ID: {product_to_subscribe_id}).")
             else:
-                product_name = product_doc.to_dict()['name']
                 await ctx.send(f"ℹ️ This {'channel' if ctx.guild else 'user'} is already subscribed to '{product_name}'.")
         else:
             await ctx.send(f"❌ Product with keyword/ID '{product_keyword_or_id}' not found. Please check `/list_monitored_products` for available items.")
@@ -506,43 +1294,39 @@ async def unsubscribe(ctx, product_keyword_or_id: Optional[str] = None):
     """Unsubscribes the channel/user from restock alerts."""
     entity_id = str(ctx.channel.id) if ctx.guild else str(ctx.author.id)
     sub_ref = db.collection('subscriptions').document(entity_id)
-    sub_doc = sub_ref.get()
+    sub_doc = await fs_get(sub_ref)
 
     if not sub_doc.exists:
         await ctx.send("ℹ️ This channel/user is not currently subscribed to any alerts.")
         return
 
-    current_subscriptions = sub_doc.to_dict().get('subscribed_product_ids', [])
+    sub_data = sub_doc.to_dict()
+    current_subscriptions = _subscribed_ids(sub_data)
+    has_legacy_list = isinstance(sub_data.get('subscribed_product_ids'), list)
 
     if product_keyword_or_id is None:
         # Unsubscribe from all products
-        sub_ref.update({'subscribed_product_ids': [], 'notification_preference': 'specific_products'})
+        await fs_update(sub_ref, {'subscribed_product_ids': {}, 'notification_preference': 'specific_products'})
         await ctx.send("✅ This {'channel' if ctx.guild else 'user'} has unsubscribed from **all** restock alerts.")
         logging.info(f"User/Channel {entity_id} unsubscribed from all products.")
     else:
-        # Unsubscribe from a specific product
-        product_to_unsubscribe_id = None
-        product_name = None
-
-        # Try by exact ID first
-        product_doc = db.collection('monitored_products').document(product_keyword_or_id).get()
-        if product_doc.exists:
-            product_to_unsubscribe_id = product_doc.id
-            product_name = product_doc.to_dict()['name']
-        else:
-            # Try by name (case-insensitive search)
-            products_by_name = db.collection('monitored_products').where('name', '==', product_keyword_or_id).get()
-            if products_by_name:
-                product_to_unsubscribe_id = products_by_name[0].id
-                product_name = products_by_name[0].to_dict()['name']
+        # Unsubscribe from a specific product (resolved by ID or name from the cache)
+        product = await resolve_product(product_keyword_or_id)
+        product_to_unsubscribe_id = product['id'] if product else None
+        product_name = product['name'] if product else None
 
         if product_to_unsubscribe_id:
             if product_to_unsubscribe_id in current_subscriptions:
                 current_subscriptions.remove(product_to_unsubscribe_id)
-                sub_ref.update({
-                    'subscribed_product_ids': current_subscriptions,
-                    'notification_preference': 'specific_products' if current_subscriptions else 'all_products' # Adjust preference
-                })
+                if has_legacy_list:
+                    # A dotted DELETE_FIELD is a no-op on a legacy array field,
+                    # which left the subscription live; write the converted map
+                    # (already minus this id) instead.
+                    removal = {'subscribed_product_ids': {pid: True for pid in current_subscriptions}}
+                else:
+                    removal = {f'subscribed_product_ids.{product_to_unsubscribe_id}': firestore.DELETE_FIELD}
+                removal['notification_preference'] = 'specific_products' if current_subscriptions else 'all_products' # Adjust preference
+                await fs_update(sub_ref, removal)
                 await ctx.send(f"✅ This {'channel' if ctx.guild else 'user'} has unsubscribed from alerts for '{product_name}'.")
                 logging.info(f"User/Channel {entity_id} unsubscribed from product: {product_name} (ID: {product_to_unsubscribe_id}).")
             else:
@@ -555,24 +1339,33 @@ async def list_subscriptions(ctx):
     """Lists all active subscriptions for the channel or user."""
     entity_id = str(ctx.channel.id) if ctx.guild else str(ctx.author.id)
     sub_ref = db.collection('subscriptions').document(entity_id)
-    sub_doc = sub_ref.get()
+    sub_doc = await fs_get(sub_ref)
 
     if not sub_doc.exists:
         await ctx.send("ℹ️ This channel/user is not currently subscribed to any alerts.")
         return
 
     sub_data = sub_doc.to_dict()
-    subscribed_product_ids = sub_data.get('subscribed_product_ids', [])
+    subscribed_product_ids = _subscribed_ids(sub_data)
     notification_preference = sub_data.get('notification_preference', 'specific_products')
 
     if notification_preference == 'all_products':
         await ctx.send("This {'channel' if ctx.guild else 'user'} is subscribed to alerts for **all** currently monitored products. ✨")
     elif subscribed_product_ids:
+        # Resolve names from the in-memory mirror first; one batched get_all
+        # covers whatever isn't mirrored (cold start, freshly added products).
+        products_by_id = {pid: _products_by_id[pid] for pid in subscribed_product_ids if pid in _products_by_id}
+        missing_ids = [pid for pid in subscribed_product_ids if pid not in products_by_id]
+        if missing_ids:
+            refs = [db.collection('monitored_products').document(pid) for pid in missing_ids]
+            docs = await asyncio.to_thread(lambda: list(db.get_all(refs)))
+            products_by_id.update({doc.id: doc.to_dict() for doc in docs if doc.exists})
+
         product_names = []
         for product_id in subscribed_product_ids:
-            product_doc = db.collection('monitored_products').document(product_id).get()
-            if product_doc.exists:
-                product_names.append(f"- **{product_doc.to_dict()['name']}** (ID: `{product_id}`)")
+            product_data = products_by_id.get(product_id)
+            if product_data:
+                product_names.append(f"- **{product_data['name']}** (ID: `{product_id}`)")
             else:
                 product_names.append(f"- Unknown Product (ID: `{product_id}` - may have been removed)")
         
@@ -588,38 +1381,39 @@ async def list_subscriptions(ctx):
 @bot.command(name='list_monitored_products', help='Shows a list of all Pokémon card products the bot is currently configured to monitor.')
 async def list_monitored_products(ctx):
     """Shows a list of all Pokémon card products the bot is currently configured to monitor."""
-    products_query = db.collection('monitored_products').order_by('name')
-    products = products_query.get()
+    products = await get_all_products()
 
     if not products:
         await ctx.send("ℹ️ No products are currently being monitored. Admins can add products using `/add_product`.")
         return
 
     product_list_str = []
-    for product_doc in products:
-        product_data = product_doc.to_dict()
+    for product_data in products:
         status = "Active" if product_data.get('is_active', True) else "Inactive"
         product_list_str.append(
-            f"- **{product_data['name']}** (ID: `{product_doc.id}`)\n"
+            f"- **{product_data['name']}** (ID: `{product_data['id']}`)\n"
             f"  Store: {product_data['store_name']} | Status: {status}\n"
             f"  URL: <{product_data['url']}> | Checkout: <{product_data['checkout_url']}>\n"
             f"  Last Stock: `{product_data.get('last_stock_status', 'unknown')}` | Last Checked: {format_timestamp(product_data['last_checked']) if product_data.get('last_checked') else 'N/A'}"
         )
     
-    # Discord embed has a character limit, split if necessary
+    # Discord embed has a character limit, split if necessary. Single pass:
+    # items carry their own trailing newline so chunks are a plain join-free
+    # "".join(buf) and each item's length is measured exactly once.
     description_chunks = []
-    current_chunk = []
-    current_length = 0
+    buf = []
+    size = 0
     for item in product_list_str:
-        if current_length + len(item) + 1 > 4000: # Max embed description length is 4096
-            description_chunks.append("\n".join(current_chunk))
-            current_chunk = [item]
-            current_length = len(item)
+        item_len = len(item) + 1
+        if size + item_len > 4000: # Max embed description length is 4096
+            description_chunks.append("".join(buf).rstrip("\n"))
+            buf = [item + "\n"]
+            size = item_len
         else:
-            current_chunk.append(item)
-            current_length += len(item) + 1
-    if current_chunk:
-        description_chunks.append("\n".join(current_chunk))
+            buf.append(item + "\n")
+            size += item_len
+    if buf:
+        description_chunks.append("".join(buf).rstrip("\n"))
 
     for i, chunk in enumerate(description_chunks):
         embed = discord.Embed(
@@ -639,14 +1433,10 @@ async def add_product(ctx, name: str, store_name: str, url: str, checkout_url: s
     # For now, keeping the combination of store and name for simplicity as per prompt,
     # but noting it might not be truly unique if names are similar across stores.
     product_id_base = f"{store_name.lower().replace(' ', '_').replace('.', '')}_{name.lower().replace(' ', '_').replace('.', '')}"
-    product_id = product_id_base
-    counter = 0
-    while (db.collection('monitored_products').document(product_id).get()).exists:
-        counter += 1
-        product_id = f"{product_id_base}_{counter}"
 
     product_data = {
         'name': name,
+        'name_lower': name.lower(), # Normalized for case-insensitive lookup
         'store_name': store_name,
         'url': url,
         'checkout_url': checkout_url,
@@ -655,11 +1445,30 @@ async def add_product(ctx, name: str, store_name: str, url: str, checkout_url: s
         'last_stock_status': 'unknown',
         'last_checked': firestore.SERVER_TIMESTAMP,
         'last_restock_time': None, # Null initially
+        'next_check_at': firestore.SERVER_TIMESTAMP, # Due immediately
         'is_active': True,
         'requires_javascript': requires_javascript
     }
     try:
-        db.collection('monitored_products').document(product_id).set(product_data)
+        # create() fails atomically on an existing id: no read-before-write
+        # round-trips, and no race against a concurrent add of the same name.
+        product_id = product_id_base
+        def _create(doc_id):
+            db.collection('monitored_products').document(doc_id).create(product_data)
+        try:
+            await asyncio.to_thread(_create, product_id)
+        except AlreadyExists:
+            # Same store+name already tracked; disambiguate with a short
+            # deterministic URL hash so re-adding the identical listing
+            # collides again instead of duplicating it.
+            product_id = f"{product_id_base}_{hashlib.blake2s(url.encode(), digest_size=4).hexdigest()}"
+            try:
+                await asyncio.to_thread(_create, product_id)
+            except AlreadyExists:
+                await ctx.send(f"❌ This product is already being monitored (ID: `{product_id}`).")
+                return
+        invalidate_products_cache()
+        invalidate_parse_state(product_id)
         await ctx.send(f"✅ Product '{name}' from {store_name} added for monitoring with ID: `{product_id}`. It will be checked periodically.")
         logging.info(f"Admin {ctx.author.name} added product: {name} (ID: {product_id})")
     except Exception as e:
@@ -671,27 +1480,40 @@ async def add_product(ctx, name: str, store_name: str, url: str, checkout_url: s
 async def remove_product(ctx, product_id: str):
     """Removes a product from the monitoring list (admin only)."""
     try:
-        product_doc = db.collection('monitored_products').document(product_id).get()
+        product_ref = db.collection('monitored_products').document(product_id)
+        product_doc = await fs_get(product_ref)
         if product_doc.exists:
             product_name = product_doc.to_dict()['name']
-            db.collection('monitored_products').document(product_id).delete()
-            
-            # Remove this product from all subscriptions
-            subscriptions_query = db.collection('subscriptions').where('subscribed_product_ids', 'array_contains', product_id)
-            subscriptions_docs = subscriptions_query.get()
-            
-            for sub_doc in subscriptions_docs:
-                sub_data = sub_doc.to_dict()
-                updated_product_ids = [pid for pid in sub_data.get('subscribed_product_ids', []) if pid != product_id]
-                db.collection('subscriptions').document(sub_doc.id).update({
-                    'subscribed_product_ids': updated_product_ids,
-                    'notification_preference': 'specific_products' if updated_product_ids else 'all_products' # Adjust preference
-                })
-                # Also remove from last_notified_timestamps
-                if product_id in sub_data.get('last_notified_timestamps', {}):
-                    db.collection('subscriptions').document(sub_doc.id).update({
+
+            map_query, legacy_query = _subscription_queries_for_product(product_id)
+            subscriptions_docs = await asyncio.to_thread(
+                lambda: list(map_query.get()) + list(legacy_query.get())
+            )
+
+            # Delete the product and strip it from every subscription in one
+            # WriteBatch commit (chunked under Firestore's 500-op limit).
+            def _commit_removal():
+                batch = db.batch()
+                batch.delete(product_ref)
+                pending = 1
+                for sub_doc in subscriptions_docs:
+                    sub_data = sub_doc.to_dict()
+                    updated_product_ids = [pid for pid in _subscribed_ids(sub_data) if pid != product_id]
+                    batch.update(db.collection('subscriptions').document(sub_doc.id), {
+                        'subscribed_product_ids': {pid: True for pid in updated_product_ids},
+                        'notification_preference': 'specific_products' if updated_product_ids else 'all_products', # Adjust preference
                         f'last_notified_timestamps.{product_id}': firestore.DELETE_FIELD
                     })
+                    pending += 1
+                    if pending >= _FIRESTORE_BATCH_LIMIT:
+                        batch.commit()
+                        batch = db.batch()
+                        pending = 0
+                if pending:
+                    batch.commit()
+            await asyncio.to_thread(_commit_removal)
+            invalidate_products_cache()
+            invalidate_parse_state(product_id)
 
             await ctx.send(f"✅ Product with ID '{product_id}' ('{product_name}') has been removed from monitoring and all relevant subscriptions updated.")
             logging.info(f"Admin {ctx.author.name} removed product: {product_name} (ID: {product_id})")
@@ -708,11 +1530,13 @@ async def toggle_monitoring(ctx, product_id: str, enable: str):
     enable_bool = enable.lower() == 'true'
     try:
         product_ref = db.collection('monitored_products').document(product_id)
-        product_doc = product_ref.get()
+        product_doc = await fs_get(product_ref)
 
         if product_doc.exists:
             product_name = product_doc.to_dict()['name']
-            product_ref.update({'is_active': enable_bool})
+            await fs_update(product_ref, {'is_active': enable_bool})
+            invalidate_products_cache()
+            invalidate_parse_state(product_id)
             status_text = "enabled" if enable_bool else "disabled"
             await ctx.send(f"✅ Monitoring for product '{product_name}' (ID: `{product_id}`) has been {status_text}.")
             logging.info(f"Admin {ctx.author.name} {status_text} monitoring for product: {product_name} (ID: {product_id})")
@@ -742,30 +1566,33 @@ async def reset_all_statuses(ctx):
             await ctx.send("❌ No confirmation received. Operation cancelled.")
             return
         
-        # Get all active products
-        products_query = db.collection('monitored_products')
-        products_docs = products_query.get()
-        
-        if not products_docs:
+        # Stream every product and batch the resets in one worker thread so
+        # neither the reads nor the commits block the event loop.
+        def _reset_all():
+            batch = db.batch()
+            pending = 0
+            count = 0
+            for product_doc in db.collection('monitored_products').stream():
+                batch.update(db.collection('monitored_products').document(product_doc.id), {
+                    'last_checked': firestore.SERVER_TIMESTAMP,
+                    'last_stock_status': 'out_of_stock'
+                })
+                pending += 1
+                count += 1
+                if pending >= _FIRESTORE_BATCH_LIMIT:
+                    batch.commit()
+                    batch = db.batch()
+                    pending = 0
+            if pending:
+                batch.commit()
+            return count
+
+        updated_count = await asyncio.to_thread(_reset_all)
+
+        if updated_count == 0:
             await ctx.send("❌ No products found to reset.")
             return
-        
-        # Update count
-        updated_count = 0
-        
-        # Batch update all products
-        batch = db.batch()
-        for product_doc in products_docs:
-            update_data = {
-                'last_checked': firestore.SERVER_TIMESTAMP,
-                'last_stock_status': 'out_of_stock'
-            }
-            batch.update(db.collection('monitored_products').document(product_doc.id), update_data)
-            updated_count += 1
-        
-        # Commit the batch
-        batch.commit()
-        
+
         await ctx.send(f"✅ Successfully reset {updated_count} products to 'out_of_stock' status.")
         logging.info(f"Admin {ctx.author.name} reset all product statuses to out_of_stock ({updated_count} products updated).")
     except Exception as e:
@@ -782,22 +1609,25 @@ async def set_status(ctx, product_id: str, status: str):
         return
     
     try:
-        product_doc = db.collection('monitored_products').document(product_id).get()
-        if product_doc.exists:
-            product_data = product_doc.to_dict()
-            product_name = product_data['name']
-            
-            # Update the status in the database
-            update_data = {
-                'last_checked': firestore.SERVER_TIMESTAMP,
-                'last_stock_status': status
-            }
-            db.collection('monitored_products').document(product_id).update(update_data)
-            
-            await ctx.send(f"✅ Status for '{product_name}' (ID: `{product_id}`) has been manually set to '{status.upper()}'.")
-            logging.info(f"Admin {ctx.author.name} manually set status for product: {product_name} (ID: {product_id}) to {status}")
-        else:
+        product_ref = db.collection('monitored_products').document(product_id)
+
+        # Update unconditionally and let Firestore report a missing document;
+        # one round-trip instead of a get-then-update pair.
+        update_data = {
+            'last_checked': firestore.SERVER_TIMESTAMP,
+            'last_stock_status': status
+        }
+        try:
+            await fs_update(product_ref, update_data)
+        except NotFound:
             await ctx.send(f"❌ Product with ID '{product_id}' not found.")
+            return
+        invalidate_products_cache()
+
+        cached_product = _products_by_id.get(product_id)
+        product_name = cached_product['name'] if cached_product else product_id
+        await ctx.send(f"✅ Status for '{product_name}' (ID: `{product_id}`) has been manually set to '{status.upper()}'.")
+        logging.info(f"Admin {ctx.author.name} manually set status for product: {product_name} (ID: {product_id}) to {status}")
     except Exception as e:
         await ctx.send(f"❌ Error setting product status: {e}")
         logging.error(f"Error setting status for product '{product_id}': {e}")
@@ -807,7 +1637,7 @@ async def set_status(ctx, product_id: str, status: str):
 async def check_product(ctx, product_id: str):
     """Checks the current stock status of a product without sending notifications (admin only)."""
     try:
-        product_doc = db.collection('monitored_products').document(product_id).get()
+        product_doc = await fs_get(db.collection('monitored_products').document(product_id))
         if product_doc.exists:
             product_data = product_doc.to_dict()
             product_data['id'] = product_id  # Add ID to product data for easier access
@@ -844,8 +1674,8 @@ async def check_product(ctx, product_id: str):
                 'last_checked': firestore.SERVER_TIMESTAMP,
                 'last_stock_status': current_stock_status
             }
-            db.collection('monitored_products').document(product_id).update(update_data)
-            
+            await fs_update(db.collection('monitored_products').document(product_id), update_data)
+
             logging.info(f"Admin {ctx.author.name} manually checked product: {product_data['name']} (ID: {product_id}), Status: {current_stock_status}")
         else:
             await ctx.send(f"❌ Product with ID '{product_id}' not found.")
@@ -861,39 +1691,51 @@ async def check_all_products(ctx):
         # Initial response
         status_msg = await ctx.send("🔍 Checking all products... This may take some time.")
         
-        # Get all products
-        products_query = db.collection('monitored_products')
-        products_docs = products_query.get()
-        
+        # Stream all products in a worker thread; the sync client's iterator
+        # does its network waits off the event loop.
+        products_docs = await fs_query(db.collection('monitored_products'))
+
         if not products_docs:
             await ctx.send("❌ No products found to check.")
             return
         
+        # One formatted timestamp for the whole run; every product was checked
+        # in the same sweep, so per-embed re-formatting would be wasted work.
+        checked_at_str = format_timestamp(datetime.now(timezone.utc))
+
         embed = discord.Embed(
             title="Stock Status Check - All Products",
             description="Current stock status for all monitored products:",
             color=discord.Color.blue()
         )
-        
+
         in_stock_products = []
         out_of_stock_products = []
         unknown_products = []
-        
-        # Check each product
-        for product_doc in products_docs:
+
+        # Scrapes are independent network waits: run them concurrently, capped
+        # by a local semaphore on top of the per-host fetch limits, instead of
+        # serially with a fixed sleep between each.
+        check_sem = asyncio.Semaphore(10)
+
+        async def _check_one(product_doc):
             product_data = product_doc.to_dict()
             product_data['id'] = product_doc.id
-            
-            current_stock_status = await check_stock_status(product_data)
-            last_stock_status = product_data.get('last_stock_status', 'unknown')
-            
-            # Update the database
-            update_data = {
+            async with check_sem:
+                status = await check_stock_status(product_data)
+            return product_data, status
+
+        results = await asyncio.gather(
+            *(_check_one(product_doc) for product_doc in products_docs)
+        )
+
+        pending_updates = []
+        for product_data, current_stock_status in results:
+            pending_updates.append((product_data['id'], {
                 'last_checked': firestore.SERVER_TIMESTAMP,
                 'last_stock_status': current_stock_status
-            }
-            db.collection('monitored_products').document(product_data['id']).update(update_data)
-            
+            }))
+
             # Sort products by status
             product_info = f"**{product_data['name']}** - {product_data['store_name']} (ID: `{product_data['id']}`)"
             if current_stock_status == "in_stock":
@@ -902,10 +1744,10 @@ async def check_all_products(ctx):
                 out_of_stock_products.append(product_info)
             else:
                 unknown_products.append(product_info)
-            
-            # Add a small delay between checks to avoid rate limiting
-            await asyncio.sleep(3)
-        
+
+        # One batched commit for the whole sweep instead of a write per product
+        await _commit_product_updates(pending_updates)
+
         # Build embed with results
         if in_stock_products:
             embed.add_field(
@@ -928,8 +1770,8 @@ async def check_all_products(ctx):
                 inline=False
             )
         
-        embed.set_footer(text=f"Last Checked: {format_timestamp(datetime.now(timezone.utc))}")
-        
+        embed.set_footer(text=f"Last Checked: {checked_at_str}")
+
         # Delete the "checking" message and send results
         await status_msg.delete()
         await ctx.send(embed=embed)
@@ -981,101 +1823,225 @@ async def help_poke(ctx):
     await ctx.send(embed=embed)
 
 # --- Background Task for Monitoring ---
-@tasks.loop(seconds=MONITORING_INTERVAL_SECONDS)
+# Drift-corrected scheduling: the loop ticks every 15 seconds but a cycle only
+# starts once the previous one's jittered due time has passed, so an overlong
+# cycle (slow Selenium pages) delays the next instead of stacking on top of
+# it, and the jitter keeps polling from looking metronomic to the stores. The
+# tick is deliberately much finer than MONITORING_INTERVAL_SECONDS so the
+# jittered due time is honoured within seconds rather than rounded up to the
+# next minute tick.
+_next_cycle_at = 0.0
+
+@tasks.loop(seconds=15)
 async def monitor_restocks():
     """
     Background task that periodically checks for product restocks and sends notifications.
     """
-    start_time = datetime.now()
+    global _next_cycle_at
+    if time.monotonic() < _next_cycle_at:
+        return
+    start_time = time.perf_counter()
     logging.info("Starting restock monitoring cycle...")
     
-    # Fetch all active products
-    active_products_query = db.collection('monitored_products').where('is_active', '==', True)
-    products_docs = active_products_query.get()
-    
-    if not products_docs:
+    # Served from the snapshot-listener mirror once it's warm, so steady-state
+    # cycles read no product documents from Firestore at all.
+    active_products = await get_active_products()
+
+    if not active_products:
         logging.info("No active products to monitor.")
         return
 
-    for product_doc in products_docs:
-        product_data = product_doc.to_dict()
-        product_data['id'] = product_doc.id # Add ID to product data for easier access
+    # Check all products concurrently; the global and per-host fetch semaphores
+    # keep the fan-out polite, so cycle time tracks the slowest check rather
+    # than the sum of all of them.
+    # The subscription index is built lazily, at most once per cycle, the
+    # first time a restock actually needs to fan out; cycles without restocks
+    # (the overwhelming majority) read no subscriptions at all.
+    sub_index_task: List[Optional[asyncio.Task]] = [None]
+
+    def get_sub_index() -> asyncio.Task:
+        if sub_index_task[0] is None:
+            sub_index_task[0] = asyncio.ensure_future(_build_subscription_index())
+        return sub_index_task[0]
+
+    results = await asyncio.gather(
+        *(_monitor_one_product(product_data, get_sub_index) for product_data in active_products),
+        return_exceptions=True
+    )
+    pending_updates = []
+    for result in results:
+        if isinstance(result, Exception):
+            logging.error(f"Error during product monitoring: {result}")
+        elif result:
+            pending_updates.append(result)
+
+    # Commit all product updates for the cycle in chunked batches
+    try:
+        await _commit_product_updates(pending_updates)
+    except Exception as e:
+        logging.error(f"Error committing monitoring updates to Firestore: {e}")
+    if pending_updates:
+        # Statuses just changed in Firestore; drop the cached listings so the
+        # next command reflects them.
+        invalidate_products_cache()
+
+    # Deferred last_checked stamps for unchanged products go out in one batch
+    # every few cycles instead of one write per product per cycle.
+    global _cycles_since_flush
+    _cycles_since_flush += 1
+    if _cycles_since_flush >= _LAST_CHECKED_FLUSH_CYCLES:
+        _cycles_since_flush = 0
+        try:
+            await _flush_last_checked()
+        except Exception as e:
+            logging.error(f"Error flushing deferred last_checked stamps: {e}")
 
-        current_stock_status = await check_stock_status(product_data)
-        last_stock_status = product_data.get('last_stock_status', 'unknown')
-        consecutive_oos_checks = product_data.get('consecutive_out_of_stock_checks', 0)
-        
-        logging.info(f"Checking {product_data['name']} (ID: {product_data['id']}): Current '{current_stock_status}', Last '{last_stock_status}', Consecutive OOS: {consecutive_oos_checks}")
+    # Calculate how long the cycle took; perf_counter is monotonic and
+    # immune to wall-clock adjustments.
+    elapsed_seconds = time.perf_counter() - start_time
+    logging.info(f"Restock monitoring cycle finished in {elapsed_seconds:.2f} seconds.")
+    _next_cycle_at = time.monotonic() + MONITORING_INTERVAL_SECONDS + random.uniform(-15, 15)
+
+@monitor_restocks.before_loop
+async def _before_monitor_restocks():
+    """Holds the monitoring loop until the gateway connection is ready."""
+    await bot.wait_until_ready()
+
+# Bookkeeping for checks whose outcome didn't change: the Firestore write is
+# skipped, the product's next due time is tracked here instead, and the
+# last_checked stamps are flushed in one batch every few cycles.
+_next_check_memo: Dict[str, datetime] = {}
+_last_checked_pending: set = set()
+_LAST_CHECKED_FLUSH_CYCLES = 5
+_cycles_since_flush = 0
+
+async def _flush_last_checked():
+    """Batch-writes the deferred last_checked stamps for unchanged products."""
+    if not _last_checked_pending:
+        return
+    pending = []
+    for product_id in _last_checked_pending:
+        update_data = {'last_checked': firestore.SERVER_TIMESTAMP}
+        next_at = _next_check_memo.get(product_id)
+        if next_at:
+            update_data['next_check_at'] = next_at
+        pending.append((product_id, update_data))
+    _last_checked_pending.clear()
+    await _commit_product_updates(pending)
+
+async def _build_subscription_index():
+    """Reads all subscriptions and indexes them for restock fan-out.
+
+    Returns (subs_by_product, all_products_subs, subs_by_id) where the first
+    maps product_id -> subscriber ids, the second is the set of subscribers
+    on the all_products preference, and the third holds each subscription's
+    data. Every per-product fan-out reads these maps only; no subscription
+    document is ever re-fetched during a cycle.
+    """
+    if _subs_listener_ready:
+        # The push-updated mirror already holds every subscription.
+        sub_items = list(_subs_by_doc.items())
+    else:
+        docs = await fs_query(db.collection('subscriptions'))
+        sub_items = [(sub_doc.id, sub_doc.to_dict()) for sub_doc in docs]
+    subs_by_product = defaultdict(list)
+    all_products_subs = set()
+    subs_by_id = {}
+    for sub_id, sub_data in sub_items:
+        subs_by_id[sub_id] = sub_data
+        if sub_data.get('notification_preference') == 'all_products':
+            all_products_subs.add(sub_id)
+        for product_id in _subscribed_ids(sub_data):
+            subs_by_product[product_id].append(sub_id)
+    return subs_by_product, all_products_subs, subs_by_id
+
+async def _monitor_one_product(product_data, get_sub_index):
+    """Checks a single product and sends notifications.
+
+    Takes the product dict (id included) from the products cache and a
+    callable yielding the shared per-cycle subscription index task; returns
+    (product_id, update_data) for the cycle-level batched commit.
+    """
+    # Staggered scheduling: skip products that aren't due yet. The filter runs
+    # client-side so legacy documents without next_check_at (which a
+    # server-side where() would silently exclude) still get checked. Skipped
+    # writes park their due time in _next_check_memo, so check it first.
+    product_id = product_data['id']
+    next_check_at = _next_check_memo.get(product_id) or product_data.get('next_check_at')
+    if next_check_at and next_check_at > datetime.now(timezone.utc):
+        return None
 
-        # Update tracking fields
-        update_data = {
-            'last_checked': firestore.SERVER_TIMESTAMP,
-            'last_stock_status': current_stock_status
-        }
-        
-        # Track consecutive out-of-stock checks
-        if current_stock_status == "out_of_stock":
-            update_data['consecutive_out_of_stock_checks'] = consecutive_oos_checks + 1
-        elif current_stock_status == "in_stock":
-            update_data['consecutive_out_of_stock_checks'] = 0
+    current_stock_status = await check_stock_status(product_data)
+    last_stock_status = product_data.get('last_stock_status', 'unknown')
+    consecutive_oos_checks = product_data.get('consecutive_out_of_stock_checks', 0)
+
+    logging.info(f"Checking {product_data['name']} (ID: {product_id}): Current '{current_stock_status}', Last '{last_stock_status}', Consecutive OOS: {consecutive_oos_checks}")
+
+    if current_stock_status == "out_of_stock":
+        new_oos_checks = consecutive_oos_checks + 1
+    elif current_stock_status == "in_stock":
+        new_oos_checks = 0
+    else:
+        new_oos_checks = consecutive_oos_checks
+
+    restock_detected = (current_stock_status == "in_stock"
+                        and last_stock_status == "out_of_stock"
+                        and consecutive_oos_checks >= 2)
+
+    # Nothing changed: skip the Firestore write entirely. The due time lives
+    # in memory and last_checked is flushed in batches every few cycles.
+    if current_stock_status == last_stock_status and new_oos_checks == consecutive_oos_checks and not restock_detected:
+        _next_check_memo[product_id] = datetime.now(timezone.utc) + timedelta(seconds=_interval_for_status(current_stock_status, new_oos_checks))
+        _last_checked_pending.add(product_id)
+        return None
+    _next_check_memo.pop(product_id, None)
+
+    # Update tracking fields
+    update_data = {
+        'last_checked': firestore.SERVER_TIMESTAMP,
+        'last_stock_status': current_stock_status,
+        'next_check_at': datetime.now(timezone.utc) + timedelta(seconds=_interval_for_status(current_stock_status, new_oos_checks)),
+        'consecutive_out_of_stock_checks': new_oos_checks
+    }
+
+    # Persist the page's conditional-GET validators so they survive restarts.
+    validators = _etag_cache.get(product_data['url'])
+    if validators:
+        update_data['etag'], update_data['last_modified'] = validators
+
+    # Restock detected: Strict conditions to prevent false positives
+    # 1. Current status must be in_stock
+    # 2. Last status must be out_of_stock
+    # 3. Must have had at least 2 consecutive out_of_stock checks before this
+    if restock_detected:
+        logging.info(f"RESTOCK DETECTED for {product_data['name']} (ID: {product_data['id']})!")
+        update_data['last_restock_time'] = firestore.SERVER_TIMESTAMP
         
-        # Restock detected: Strict conditions to prevent false positives
-        # 1. Current status must be in_stock
-        # 2. Last status must be out_of_stock
-        # 3. Must have had at least 2 consecutive out_of_stock checks before this
-        if current_stock_status == "in_stock" and last_stock_status == "out_of_stock" and consecutive_oos_checks >= 2:
-            logging.info(f"RESTOCK DETECTED for {product_data['name']} (ID: {product_data['id']})!")
-            update_data['last_restock_time'] = firestore.SERVER_TIMESTAMP
-            
-            # Find all relevant subscriptions
-            # Option 1: Channels subscribed to this specific product_id
-            specific_subs_query = db.collection('subscriptions').where('subscribed_product_ids', 'array_contains', product_data['id'])
-            specific_subs = specific_subs_query.get()
-
-            # Option 2: Channels subscribed to 'all_products'
-            all_subs_query = db.collection('subscriptions').where('notification_preference', '==', 'all_products')
-            all_subs = all_subs_query.get()
-            
-            # Combine and deduplicate subscriber IDs
-            subscriber_ids = set()
-            for sub_doc in specific_subs:
-                subscriber_ids.add(sub_doc.id)
-            for sub_doc in all_subs:
-                subscriber_ids.add(sub_doc.id) # Add if not already present
-
-            for subscriber_id in subscriber_ids:
-                sub_doc = db.collection('subscriptions').document(subscriber_id).get()
-                if sub_doc.exists:
-                    sub_data = sub_doc.to_dict()
-                    last_notified_timestamp_for_product = sub_data.get('last_notified_timestamps', {}).get(product_data['id'])
-                    
-                    # Only notify if this specific restock event hasn't been notified to this subscriber
-                    # This check is crucial to prevent spamming the same restock repeatedly
-                    if not last_notified_timestamp_for_product or \
-                       (product_data['last_restock_time'] and last_notified_timestamp_for_product.to_datetime() < product_data['last_restock_time'].to_datetime()):
-                        
-                        # Ensure the last_restock_time in the database is actually newer than the last notification
-                        # This handles cases where the bot restarts or the product was already in stock but not notified
-                        
-                        await send_restock_notification(product_data, subscriber_id)
-                    else:
-                        logging.info(f"Skipping notification for {product_data['name']} to {subscriber_id} as already notified for this restock.")
-                else:
-                    logging.warning(f"Subscription document {subscriber_id} not found during notification.")
+        # Fan out from the per-cycle subscription index: subscribers of this
+        # product plus everyone on the all_products preference, deduplicated.
+        # Concurrent restocks in one cycle share a single index build.
+        subs_by_product, all_products_subs, subs_by_id = await get_sub_index()
+        subscriber_ids = all_products_subs.union(subs_by_product.get(product_data['id'], ()))
 
-        # Update product data in Firestore
-        try:
-            db.collection('monitored_products').document(product_data['id']).update(update_data)
-        except Exception as e:
-            logging.error(f"Error updating product {product_data['id']} in Firestore: {e}")
+        for subscriber_id in subscriber_ids:
+            sub_data = subs_by_id[subscriber_id]
+            last_notified_timestamp_for_product = sub_data.get('last_notified_timestamps', {}).get(product_data['id'])
 
-        # Add a small delay between product checks to avoid overwhelming sites
-        await asyncio.sleep(5) # Adjust based on number of products and website policies
+            # Only notify if this specific restock event hasn't been notified to this subscriber
+            # This check is crucial to prevent spamming the same restock repeatedly
+            if not last_notified_timestamp_for_product or \
+               (product_data.get('last_restock_time') and last_notified_timestamp_for_product.to_datetime() < product_data['last_restock_time'].to_datetime()):
+
+                # Ensure the last_restock_time in the database is actually newer than the last notification
+                # This handles cases where the bot restarts or the product was already in stock but not notified
+
+                await send_restock_notification(product_data, subscriber_id)
+            else:
+                logging.info(f"Skipping notification for {product_data['name']} to {subscriber_id} as already notified for this restock.")
+
+    # Returned to the cycle for one batched Firestore commit
+    return product_data['id'], update_data
 
-    # Calculate how long the cycle took
-    end_time = datetime.now()
-    elapsed_seconds = (end_time - start_time).total_seconds()
-    logging.info(f"Restock monitoring cycle finished in {elapsed_seconds:.2f} seconds.")
 
 # --- Bot Events ---
 @bot.event